@@ -1,87 +1,123 @@
 import os
+import io
 import hmac
 import hashlib
 import base64
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import gradio as gr
 import soundfile as sf
-import librosa
 import numpy as np
-from smolagents import tool, CodeAgent
-from huggingface_hub import InferenceClient
-import tempfile
+from collections import OrderedDict
+from typing import Optional
+import soxr
+
+# Extractor de huellas de ACRCloud (paquete opcional `pyacrcloud`)
+try:
+    import acrcloud_extr_tool
+except ImportError:
+    acrcloud_extr_tool = None
 
 # Cargar claves de entorno
 ACR_ACCESS_KEY = os.environ.get("ACR_ACCESS_KEY")
 ACR_SECRET_KEY = os.environ.get("ACR_SECRET_KEY")
 HF_TOKEN = os.environ.get("HF_TOKEN")
+DEBUG = os.environ.get("DEBUG") == "1"
 
 if not all([ACR_ACCESS_KEY, ACR_SECRET_KEY, HF_TOKEN]):
     raise ValueError("Faltan variables de entorno necesarias")
 
-# Configuración del modelo LLM
-llm = InferenceClient(model="mistralai/Mixtral-8x7B-Instruct-v0.1", token=HF_TOKEN)
+# HMAC-SHA1 con la clave secreta ya cargada; cada petición firma sobre una copia
+ACR_HMAC = hmac.new(ACR_SECRET_KEY.encode("ascii"), digestmod=hashlib.sha1)
+
+# Configuración del modelo LLM: el cliente (y huggingface_hub) se carga en el primer uso
+llm = None
+llm_lock = threading.Lock()
+
+def get_llm():
+    global llm
+    if llm is None:
+        with llm_lock:
+            if llm is None:
+                from huggingface_hub import InferenceClient
+                # Un único cliente para todo el proceso; timeout para no colgar un worker si HF no responde
+                llm = InferenceClient(model="mistralai/Mixtral-8x7B-Instruct-v0.1", token=HF_TOKEN, timeout=30)
+    return llm
+
+# Peticiones que Gradio atiende a la vez por evento (ver los .click de la interfaz)
+HANDLER_CONCURRENCY = 8
+
+# Hilos para lanzar en paralelo las consultas al LLM: dos por reconocimiento en curso
+llm_executor = ThreadPoolExecutor(max_workers=2 * HANDLER_CONCURRENCY)
 
 # Wrapper para LLM
 class LLMWrapper:
     def __init__(self, client):
         self.client = client
+        self.generate = client.text_generation
 
     def __call__(self, prompt, **kwargs):
-        print(f"Received prompt: {prompt}")
-        if isinstance(prompt, list):
+        if isinstance(prompt, str):
+            text = prompt
+        elif isinstance(prompt, list):
+            # Primer mensaje con texto; si no hay ninguno, el primer elemento tal cual
+            text = None
             for msg in prompt:
                 if isinstance(msg, dict):
                     text = msg.get("text") or msg.get("content")
                     if text:
-                        print(f"Extracted text: {text}")
-                        return self.client.text_generation(text, max_new_tokens=500, temperature=0.7)
-            text = str(prompt[0]) if prompt else str(prompt)
-            print(f"Fallback text from list: {text}")
-            return self.client.text_generation(text, max_new_tokens=500, temperature=0.7)
-        text = str(prompt)
-        print(f"Using string directly: {text}")
-        return self.client.text_generation(text, max_new_tokens=500, temperature=0.7)
-
-# Herramienta de reconocimiento
-@tool
-def recognize_song(audio_path: str) -> dict:
-    """
-    Recognize a song from an audio file using the ACRCloud API.
+                        break
+            if not text:
+                text = str(prompt[0]) if prompt else str(prompt)
+        else:
+            text = str(prompt)
+        if DEBUG:
+            print(f"Prompt para el LLM: {text}")
+        return self.generate(text, max_new_tokens=500, temperature=0.7)
 
-    Args:
-        audio_path (str): Path to the audio file to be recognized (e.g., 'temp_audio.wav').
+# Reconocimiento con ACRCloud a partir de una muestra ya codificada
+ACR_URL = "http://identify-eu-west-1.acrcloud.com/v1/identify"
+ACR_SIGNATURE_VERSION = "1"
+# Parte fija de la cadena a firmar; en cada petición solo cambia el timestamp
+ACR_SIGN_PREFIXES = {
+    data_type: f"POST\n/v1/identify\n{ACR_ACCESS_KEY}\n{data_type}\n{ACR_SIGNATURE_VERSION}\n".encode("ascii")
+    for data_type in ("audio", "fingerprint")
+}
+ACR_TIMEOUT = (3, 10)  # segundos (conexión, lectura)
+MIN_CLIP_SECONDS = 3
+MAX_CLIP_SECONDS = 10
+OPUS_COMPRESSION_LEVEL = 0.96  # ≈16 kbit/s con libsndfile para mono a 8 kHz
+INT16_SCALE = np.float32(1.0 / 32768.0)
+SILENCE_ENERGY = 1e-4  # energía media (muestras en [-1, 1]) por debajo de la cual el clip es silencio
 
-    Returns:
-        dict: Dictionary containing song details if successful, or an error message if failed.
-              Possible keys on success: 'title', 'artist', 'album', 'release_date'.
-              On failure: {'error': str}.
-    """
-    try:
-        audio_data, sample_rate = sf.read(audio_path)
-        if sample_rate != 8000:
-            print(f"Warning: Sample rate is {sample_rate}, expected 8000 Hz.")
+# Sesión compartida: reutiliza la conexión TCP con ACRCloud entre peticiones
+acr_session = requests.Session()
+acr_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=Retry(total=1, backoff_factor=0.1)))
 
-        url = "http://identify-eu-west-1.acrcloud.com/v1/identify"
+def identify_sample(sample: bytes, filename: str, content_type: str, data_type: str = "audio") -> dict:
+    try:
         timestamp = str(int(time.time()))
-        data_type = "audio"
-        signature_version = "1"
-        string_to_sign = f"POST\n/v1/identify\n{ACR_ACCESS_KEY}\n{data_type}\n{signature_version}\n{timestamp}"
-        sign = base64.b64encode(hmac.new(ACR_SECRET_KEY.encode("ascii"), string_to_sign.encode("ascii"), digestmod=hashlib.sha1).digest()).decode("ascii")
+        signer = ACR_HMAC.copy()
+        signer.update(ACR_SIGN_PREFIXES[data_type] + timestamp.encode("ascii"))
+        sign = base64.b64encode(signer.digest()).decode("ascii")
 
-        files = {"sample": (audio_path, open(audio_path, "rb"), "audio/wav")}
+        files = {"sample": (filename, sample, content_type)}
         data = {
             "access_key": ACR_ACCESS_KEY,
             "data_type": data_type,
-            "signature_version": signature_version,
+            "signature_version": ACR_SIGNATURE_VERSION,
             "signature": sign,
-            "sample_bytes": os.path.getsize(audio_path),
+            "sample_bytes": len(sample),
             "timestamp": timestamp
         }
 
-        response = requests.post(url, files=files, data=data)
-        response_data = response.json()
+        response = acr_session.post(ACR_URL, files=files, data=data, timeout=ACR_TIMEOUT)
+        response_data = orjson.loads(response.content)
 
         if response_data.get("status", {}).get("code") == 0:
             if "metadata" in response_data and "music" in response_data["metadata"] and response_data["metadata"]["music"]:
@@ -96,18 +132,120 @@ def recognize_song(audio_path: str) -> dict:
                 return {"error": "No se encontraron coincidencias para el audio proporcionado"}
         else:
             return {"error": response_data.get("status", {}).get("msg", "Error desconocido en ACRCloud")}
+    except Exception as e:
+        print(f"Error in identify_sample: {str(e)}")
+        return {"error": str(e)}
+
+# Herramienta de reconocimiento (se registra con @tool de smolagents al crear el agente)
+def recognize_song(audio_path: str) -> dict:
+    """
+    Recognize a song from an audio file using the ACRCloud API.
+
+    Args:
+        audio_path (str): Path to the audio file to be recognized (e.g., 'temp_audio.wav').
+
+    Returns:
+        dict: Dictionary containing song details if successful, or an error message if failed.
+              Possible keys on success: 'title', 'artist', 'album', 'release_date'.
+              On failure: {'error': str}.
+    """
+    try:
+        # Una sola apertura del archivo: la cabecera se lee de los bytes ya cargados
+        with open(audio_path, "rb") as f:
+            sample = f.read()
+        sample_rate = sf.info(io.BytesIO(sample)).samplerate
+        if sample_rate != 8000:
+            print(f"Warning: Sample rate is {sample_rate}, expected 8000 Hz.")
+    except FileNotFoundError:
+        return {"error": f"No existe el archivo de audio: {audio_path}"}
     except Exception as e:
         print(f"Error in recognize_song: {str(e)}")
         return {"error": str(e)}
+    return identify_sample(sample, os.path.basename(audio_path), "audio/wav")
+
+# Pasar a float32 y remuestrear; None si el clip es silencio
+def prepare_clip(samples: np.ndarray, sample_rate: int, target_sr: int) -> Optional[np.ndarray]:
+    # ACRCloud trabaja en mono: mezclar los canales antes de escalar, así la conversión
+    # a float32 solo recorre un canal
+    if samples.ndim == 2:
+        audio_data = samples.mean(axis=1, dtype=np.float32)
+        audio_data *= INT16_SCALE
+    else:
+        audio_data = np.multiply(samples, INT16_SCALE, dtype=np.float32)
+    # Descartar silencio antes de remuestrear, codificar o llamar a ACRCloud
+    if np.dot(audio_data, audio_data) / audio_data.size < SILENCE_ENERGY:
+        return None
+    return soxr.resample(audio_data, sample_rate, target_sr, quality="HQ")
 
-# Configuración del agente
-agent = CodeAgent(tools=[recognize_song], model=LLMWrapper(llm), additional_authorized_imports=["boto3"])
+# Identificar un clip mono a 8 kHz
+def identify_clip(audio_data: np.ndarray, sample_rate: int) -> dict:
+    if acrcloud_extr_tool is not None:
+        # Enviar solo la huella (unos pocos KB) calculada localmente sobre PCM 16-bit a 8 kHz
+        scaled = np.multiply(audio_data, np.float32(32767.0))
+        np.clip(scaled, -32767.0, 32767.0, out=scaled)
+        pcm = scaled.astype(np.int16).tobytes()
+        fingerprint = acrcloud_extr_tool.create_fingerprint(pcm, False)
+        return identify_sample(fingerprint, "sample.fp", "application/octet-stream", data_type="fingerprint")
+    # Codificar en memoria (Ogg/Opus) y enviar sin pasar por disco; libopus trabaja en
+    # float, así que el clip se pasa en float32 sin cuantizar
+    buffer = io.BytesIO()
+    sf.write(buffer, audio_data, sample_rate, format="OGG", subtype="OPUS", compression_level=OPUS_COMPRESSION_LEVEL)
+    return identify_sample(buffer.getvalue(), "sample.ogg", "audio/ogg")
+
+# Grabaciones ya reconocidas, por digest BLAKE2b de las muestras originales (se descartan las más antiguas)
+EXACT_MATCHES_MAX = 64
+exact_matches = OrderedDict()
+exact_matches_lock = threading.Lock()
+
+def find_exact_match(digest: bytes) -> Optional[dict]:
+    with exact_matches_lock:
+        return exact_matches.get(digest)
+
+def remember_exact_match(digest: bytes, result: dict):
+    with exact_matches_lock:
+        exact_matches[digest] = result
+        exact_matches.move_to_end(digest)
+        while len(exact_matches) > EXACT_MATCHES_MAX:
+            exact_matches.popitem(last=False)
+
+# Configuración del agente: uno por hilo de trabajo de Gradio, para que dos usuarios
+# atendidos a la vez no compartan (ni pisen) la memoria de la misma instancia
+agent_local = threading.local()
+
+def get_agent():
+    if not hasattr(agent_local, "agent"):
+        # smolagents solo se importa cuando hace falta el agente por primera vez
+        from smolagents import CodeAgent, tool
+        agent_local.agent = CodeAgent(tools=[tool(recognize_song)], model=LLMWrapper(get_llm()), additional_authorized_imports=["boto3"])
+    return agent_local.agent
+
+# Respuestas del LLM por (tipo, artista) con caducidad; los errores no se guardan
+LLM_CACHE_TTL = 24 * 3600
+LLM_CACHE_MAX = 512
+llm_cache = {}  # (tipo, artista) -> (timestamp, texto), en orden de inserción
+llm_cache_lock = threading.Lock()
+
+def cached_generation(kind: str, artist_name: str, prompt: str) -> str:
+    key = (kind, artist_name)
+    now = time.time()
+    with llm_cache_lock:
+        entry = llm_cache.get(key)
+    if entry is not None and now - entry[0] < LLM_CACHE_TTL:
+        return entry[1]
+    # Temperatura baja: el texto se reutiliza durante horas, mejor que sea estable
+    text = get_llm().text_generation(prompt, max_new_tokens=200, temperature=0.3)
+    with llm_cache_lock:
+        llm_cache.pop(key, None)
+        llm_cache[key] = (now, text)
+        while len(llm_cache) > LLM_CACHE_MAX:
+            del llm_cache[next(iter(llm_cache))]
+    return text
 
 # Información dinámica del artista con LLM
 def get_artist_info(artist_name: str) -> str:
     prompt = f"Dame una breve biografía de {artist_name}, destacando su carrera y estilo musical, en español."
     try:
-        return llm.text_generation(prompt, max_new_tokens=200, temperature=0.7)
+        return cached_generation("info", artist_name, prompt)
     except Exception as e:
         return f"No se pudo obtener info de {artist_name}: {str(e)}"
 
@@ -115,70 +253,106 @@ def get_artist_info(artist_name: str) -> str:
 def get_curiosities(artist_name: str) -> str:
     prompt = f"En español, lista 2-3 datos interesantes sobre {artist_name} relacionados con su música o carrera en formato:\n1. [Dato 1]\n2. [Dato 2]\n3. [Dato 3]"
     try:
-        return llm.text_generation(prompt, max_new_tokens=200, temperature=0.7)
+        return cached_generation("curiosities", artist_name, prompt)
     except Exception as e:
         return f"No hay curiosidades disponibles para {artist_name}: {str(e)}"
 
-# Procesar audio
+# Ficha de la canción; se vuelve a generar a medida que llegan las respuestas del LLM
+SONG_DETAILS_TEMPLATE = (
+    "<style>.large-text {{ font-size: 24px; line-height: 1.5; }}</style>\n"
+    "<h2>🎵 Detalles de la Canción 🎵</h2>\n"
+    "<div class='large-text'>\n"
+    "──────────────────────\n"
+    "🎵 Título: {title}\n\n"
+    "🎤 Artista: {artist}\n\n"
+    "📅 Lanzamiento: {release_date}\n\n"
+    "📀 Álbum: {album}\n\n"
+    "🏷️ Sello: No disponible en ACRCloud\n\n"
+    "🎧 Género: No disponible en ACRCloud\n"
+    "──────────────────────\n\n"
+    "👤 **Sobre {artist}** 👤\n"
+    "──────────────────────\n"
+    "{artist_info}\n\n"
+    "──────────────────────\n"
+    "✨ **Curiosidades y Anécdotas** ✨\n"
+    "──────────────────────\n"
+    "{curiosities}\n"
+    "</div>"
+)
+
+def format_song_details(result: dict, artist_info: str, curiosities: str) -> str:
+    return SONG_DETAILS_TEMPLATE.format_map({**result, "artist_info": artist_info, "curiosities": curiosities})
+
+# Procesar audio (generador: Gradio muestra cada estado en cuanto se emite)
 def process_audio(audio):
     if audio is None:
-        return "No se recibió audio.", None
+        yield "No se recibió audio.", None
+        return
+    # Con menos de unos segundos ACRCloud no puede dar una coincidencia fiable
+    if len(audio[1]) < MIN_CLIP_SECONDS * audio[0]:
+        yield f"El audio es demasiado corto: graba al menos {MIN_CLIP_SECONDS} segundos.", None
+        return
+
+    yield "🔎 Identificando la canción...", None
 
     target_sr = 8000
-    audio_data = audio[1].astype(np.float32) / 32768.0
-    audio_data = librosa.resample(audio_data, orig_sr=audio[0], target_sr=target_sr)
+    samples = audio[1]
+    # ACRCloud identifica con pocos segundos: quedarse con una ventana central acotada
+    max_samples = MAX_CLIP_SECONDS * audio[0]
+    if len(samples) > max_samples:
+        start = (len(samples) - max_samples) // 2
+        samples = samples[start:start + max_samples]
+    # Grabación idéntica a una ya reconocida: reutilizar el resultado sin procesarla
+    digest = hashlib.blake2b(np.ascontiguousarray(samples), digest_size=16).digest()
+    result = find_exact_match(digest)
+    if result is None:
+        audio_data = prepare_clip(samples, audio[0], target_sr)
+        if audio_data is None:
+            yield "El audio es demasiado silencioso para identificar la canción.", None
+            return
 
-    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_file:
-        temp_path = temp_file.name
-        sf.write(temp_path, audio_data, target_sr)
-        result = recognize_song(temp_path)
-    os.remove(temp_path)
+        result = identify_clip(audio_data, target_sr)
+        if "error" not in result:
+            remember_exact_match(digest, result)
 
     if "error" in result:
-        query = f"No se pudo identificar la canción: {result['error']}. ¿Qué puedo hacer?"
-        try:
-            agent_response = agent.run(query)
-            return agent_response, None
-        except Exception as e:
-            return f"Error al consultar al agente: {str(e)}", None
-
-    song_title = result["title"]
+        yield f"No se pudo identificar la canción ({result['error']}). Intenta con un audio más claro de 8–10 segundos.", None
+        return
+
     artist_name = result["artist"]
-    album = result["album"]
-    release_date = result["release_date"]
-    artist_info = get_artist_info(artist_name)
-    curiosities = get_curiosities(artist_name)
-
-    output = (
-        "<style>.large-text { font-size: 24px; line-height: 1.5; }</style>\n"
-        "<h2>🎵 Detalles de la Canción 🎵</h2>\n"
-        "<div class='large-text'>\n"
-        "──────────────────────\n"
-        f"🎵 Título: {song_title}\n\n"
-        f"🎤 Artista: {artist_name}\n\n"
-        f"📅 Lanzamiento: {release_date}\n\n"
-        f"📀 Álbum: {album}\n\n"
-        f"🏷️ Sello: No disponible en ACRCloud\n\n"
-        f"🎧 Género: No disponible en ACRCloud\n"
-        "──────────────────────\n\n"
-        f"👤 **Sobre {artist_name}** 👤\n"
-        "──────────────────────\n"
-        f"{artist_info}\n\n"
-        "──────────────────────\n"
-        "✨ **Curiosidades y Anécdotas** ✨\n"
-        "──────────────────────\n"
-        f"{curiosities}\n"
-        "</div>"
-    )
-    return output, artist_name
+    # Las dos consultas al LLM son independientes: lanzarlas a la vez
+    info_future = llm_executor.submit(get_artist_info, artist_name)
+    curiosities_future = llm_executor.submit(get_curiosities, artist_name)
+    pending = "⏳ Consultando..."
+    yield format_song_details(result, pending, pending), artist_name
+    artist_info = info_future.result()
+    yield format_song_details(result, artist_info, pending), artist_name
+    curiosities = curiosities_future.result()
+    yield format_song_details(result, artist_info, curiosities), artist_name
+
+# Respuestas del agente ya dadas, por (artista, pregunta) normalizados (LRU acotado)
+CHAT_CACHE_MAX = 1024
+chat_cache = OrderedDict()
+chat_cache_lock = threading.Lock()
 
 # Chat con el agente
 def chat_with_llm(message, history, artist_name):
     if not artist_name:
         return "Primero identifica una canción para chatear sobre el artista."
+    key = (artist_name.lower(), message.lower().strip())
+    with chat_cache_lock:
+        response = chat_cache.get(key)
+        if response is not None:
+            chat_cache.move_to_end(key)
+    if response is not None:
+        return f"**Tú**: {message}\n**Respuesta**: {response}"
     query = f"Pregunta sobre {artist_name}: {message}"
     try:
-        response = agent.run(query)
+        response = get_agent().run(query)
+        with chat_cache_lock:
+            chat_cache[key] = response
+            if len(chat_cache) > CHAT_CACHE_MAX:
+                chat_cache.popitem(last=False)
         return f"**Tú**: {message}\n**Respuesta**: {response}"
     except Exception as e:
         return f"**Tú**: {message}\n**Error**: {str(e)}"
@@ -199,8 +373,10 @@ with gr.Blocks(title="Music Sonar 2.0") as interface:
         chat_input = gr.Textbox(label="Pregunta algo", placeholder="E.g., ¿Qué inspira a este artista?")
         chat_submit = gr.Button("Enviar")
 
-    submit_btn.click(fn=process_audio, inputs=audio_input, outputs=[output_text, artist_state])
-    chat_submit.click(fn=chat_with_llm, inputs=[chat_input, chat_output, artist_state], outputs=chat_output)
+    # Los manejadores pasan casi todo el tiempo esperando a ACRCloud o al LLM: atender
+    # a varios usuarios a la vez en lugar del límite por defecto de 1 por evento
+    submit_btn.click(fn=process_audio, inputs=audio_input, outputs=[output_text, artist_state], concurrency_limit=HANDLER_CONCURRENCY)
+    chat_submit.click(fn=chat_with_llm, inputs=[chat_input, chat_output, artist_state], outputs=chat_output, concurrency_limit=HANDLER_CONCURRENCY)
 
 if __name__ == "__main__":
     interface.launch(share=True)